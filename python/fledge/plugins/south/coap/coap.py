@@ -30,6 +30,7 @@ c_ingest_ref = None
 loop = None
 _task = None
 t = None
+_SHUTDOWN_TIMEOUT = 5  # seconds plugin_shutdown waits for the CoAP listener to shut down
 _DEFAULT_CONFIG = {
     'plugin': {
         'description': 'CoAP Listener South Plugin',
@@ -69,6 +70,17 @@ async def _start_aiocoap(uri, port):
     _LOGGER.info('CoAP listener started on port {} with uri {}'.format(port, uri))
 
 
+async def _graceful_shutdown():
+    global aiocoap_ctx, _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
+    if aiocoap_ctx is not None:
+        # Detach the context first so that a failed shutdown is never retried on an already closed context
+        ctx, aiocoap_ctx = aiocoap_ctx, None
+        await ctx.shutdown()
+
+
 def plugin_info():
     """ Returns information about the plugin.
 
@@ -154,15 +166,14 @@ def plugin_shutdown(handle):
     Raises:
     """
     _LOGGER.info('Stopping South CoAP plugin...')
-    global aiocoap_ctx, _task, loop
     try:
-        if aiocoap_ctx is not None:
-            asyncio.ensure_future(aiocoap_ctx.shutdown(), loop=loop)
-        if _task is not None:
-            _task.cancel()
-            _task = None
-        if loop is not None:
-            loop.stop()
+        if t is not None and t.is_alive():
+            # Shut down the listener on its own loop, then stop the loop so that the listener thread exits.
+            # run_coroutine_threadsafe also covers a listener thread that has not entered run_forever yet.
+            try:
+                asyncio.run_coroutine_threadsafe(_graceful_shutdown(), loop).result(timeout=_SHUTDOWN_TIMEOUT)
+            finally:
+                loop.call_soon_threadsafe(loop.stop)
     except Exception as ex:
         _LOGGER.exception('Error in shutting down CoAP plugin {}'.format(str(ex)))
         raise
@@ -7,8 +7,7 @@
 """Unit test for python.fledge.plugins.south.coap"""
 
 import asyncio
-import copy
-import json
+import socket
 import pytest
 import cbor2
 import aiocoap.error
@@ -43,6 +42,60 @@ _NEW_CONFIG = {
     }
 }
 
+_READING_KEYS = ("readings", "sensor_values")
+
+_PAYLOAD_TEMPLATES = {reading_key: cbor2.dumps({
+    "timestamp": "2017-01-02T01:02:03.23232Z-05:00",
+    "asset": "sensor1",
+    "key": "80a43623-ebe5-40d6-8d80-3f892da9b3b4",
+    reading_key: {
+        "velocity": "500",
+        "temperature": {
+            "value": "32",
+            "unit": "kelvin"
+        }
+    }
+}) for reading_key in _READING_KEYS}
+
+_PAYLOAD_READING_NOT_DICT = cbor2.dumps({
+    "timestamp": "2017-01-02T01:02:03.23232Z-05:00",
+    "asset": "sensor2",
+    "key": "80a43623-ebe5-40d6-8d80-3f892da9b3b4",
+    "readings": "500"
+})
+
+
+def _patch_log_info(mocker, message):
+    """Patch coap._LOGGER.info; the returned asyncio.Event is set once a log message starting with
+    `message` is emitted. The plugin logs from its own listener thread, hence call_soon_threadsafe.
+    """
+    logged = asyncio.Event()
+    test_loop = asyncio.get_event_loop()
+
+    def _info(msg, *args, **kwargs):
+        if msg.startswith(message):
+            test_loop.call_soon_threadsafe(logged.set)
+
+    log_info = mocker.patch.object(coap._LOGGER, "info", side_effect=_info)
+    return log_info, logged
+
+
+def cleanup_plugin():
+    """Stop the listener thread and event loop left behind by plugin_start and reset the plugin globals"""
+    thread, loop = coap.t, coap.loop
+    try:
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout=0.5)
+            # Release the listener socket for the next test, unless plugin_shutdown already shut it down
+            if not thread.is_alive() and (coap.aiocoap_ctx is not None or coap._task is not None):
+                loop.run_until_complete(coap._graceful_shutdown())
+    finally:
+        if loop is not None and not loop.is_running():
+            loop.close()
+        coap.aiocoap_ctx = coap._task = coap.loop = coap.t = None
+    assert thread is None or not thread.is_alive(), 'CoAP listener thread did not stop'
+
 
 def test_plugin_contract():
     # Evaluates if the plugin has all the required methods
@@ -74,107 +127,106 @@ def test_plugin_init():
     assert coap.plugin_init(config) == config
 
 
-@pytest.allure.feature("unit")
-@pytest.allure.story("plugin", "south", "coap")
-@pytest.mark.asyncio
-async def test_plugin_start(mocker, unused_port):
-    # GIVEN
+@pytest.fixture(scope="module")
+def event_loop():
+    """One event loop shared by all asyncio tests of this module, instead of pytest-asyncio's per test loop"""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="module")
+def shared_port():
+    """A free UDP port, picked once and reused by every plugin lifecycle test of this module"""
+    with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as sock:
+        sock.bind(('::', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def plugin_config(mocker, shared_port):
+    """Plugin config listening on the shared port; tears down whatever plugin_start left running"""
     port = {
         'description': 'Port to listen on',
         'type': 'integer',
-        'default': str(unused_port()),
+        'default': str(shared_port),
     }
     mocker.patch.dict(config, {'port': port})
     config['port']['value'] = config['port']['default']
     config['uri']['value'] = config['uri']['default']
+    yield config
+    cleanup_plugin()
+
 
-    log_info = mocker.patch.object(coap._LOGGER, "info")
+@pytest.allure.feature("unit")
+@pytest.allure.story("plugin", "south", "coap")
+@pytest.mark.asyncio
+async def test_plugin_start(plugin_config, mocker):
+    # GIVEN
+    log_info, started = _patch_log_info(mocker, 'CoAP listener started')
     assert coap.aiocoap_ctx is None
 
     # WHEN
-    coap.plugin_start(config)
-    await asyncio.sleep(.3)  # required to allow ensure_future task to complete
+    coap.plugin_start(plugin_config)
+    await asyncio.wait_for(started.wait(), timeout=2.0)  # wait for ensure_future task to complete
 
     # THEN
     assert coap.aiocoap_ctx is not None
     assert 1 == log_info.call_count
-    calls = [call('CoAP listener started on port {} with uri {}'.format(config['port']['value'], config['uri']['value']))]
+    port, uri = plugin_config['port']['value'], plugin_config['uri']['value']
+    calls = [call('CoAP listener started on port {} with uri {}'.format(port, uri))]
     log_info.assert_has_calls(calls, any_order=True)
 
-    coap.loop.stop()
-    coap.t._tstate_lock = None
-    coap.t._stop()
-
 
 @pytest.allure.feature("unit")
 @pytest.allure.story("plugin", "south", "coap")
 @pytest.mark.asyncio
-async def test_plugin_reconfigure(mocker, unused_port):
+async def test_plugin_reconfigure(plugin_config, mocker):
     # GIVEN
-    port = {
-        'description': 'Port to listen on',
-        'type': 'integer',
-        'default': str(unused_port()),
-    }
-    mocker.patch.dict(config, {'port': port})
-    config['port']['value'] = config['port']['default']
-    config['uri']['value'] = config['uri']['default']
-    new_config = copy.deepcopy(_NEW_CONFIG)
+    new_config = {k: dict(v) for k, v in _NEW_CONFIG.items()}  # leaf values are immutable strings
     new_config['port']['value'] = new_config['port']['default']
     new_config['uri']['value'] = new_config['uri']['default']
-    log_info = mocker.patch.object(coap._LOGGER, "info")
+    log_info, started = _patch_log_info(mocker, 'CoAP listener started')
 
     # WHEN
-    new_handle = coap.plugin_reconfigure(config, new_config)
-    await asyncio.sleep(.3)  # required to allow ensure_future task to complete
+    new_handle = coap.plugin_reconfigure(plugin_config, new_config)
+    await asyncio.wait_for(started.wait(), timeout=2.0)  # wait for ensure_future task to complete
 
     # THEN
     assert new_config == new_handle
 
     # TODO: assert plugin_shutdown, plugin_init, plugin_start called
     assert 3 == log_info.call_count
-    calls = [call("Old config for CoAP plugin {} \n new config {}".format(config, new_config)),
+    calls = [call("Old config for CoAP plugin {} \n new config {}".format(plugin_config, new_config)),
              call('Stopping South CoAP plugin...'),
              call('CoAP listener started on port 1234 with uri sensor-values')]
     log_info.assert_has_calls(calls, any_order=True)
 
-    coap.loop.stop()
-    coap.t._tstate_lock = None
-    coap.t._stop()
-
 
 @pytest.allure.feature("unit")
 @pytest.allure.story("plugin", "south", "coap")
 @pytest.mark.asyncio
-async def test_plugin_shutdown(mocker, unused_port):
+async def test_plugin_shutdown(plugin_config, mocker):
     # GIVEN
-    port = {
-        'description': 'Port to listen on',
-        'type': 'integer',
-        'default': str(unused_port()),
-    }
-    mocker.patch.dict(config, {'port': port})
-    config['port']['value'] = config['port']['default']
-    config['uri']['value'] = config['uri']['default']
     log_exception = mocker.patch.object(coap._LOGGER, "exception")
-    log_info = mocker.patch.object(coap._LOGGER, "info")
+    log_info, started = _patch_log_info(mocker, 'CoAP listener started')
 
-    coap.plugin_start(config)
-    await asyncio.sleep(.3)  # required to allow ensure_future task to complete
+    coap.plugin_start(plugin_config)
+    await asyncio.wait_for(started.wait(), timeout=2.0)  # wait for ensure_future task to complete
 
     # WHEN
-    coap.plugin_shutdown(config)
+    coap.plugin_shutdown(plugin_config)
 
     # THEN
+    assert coap.aiocoap_ctx is None
+    assert coap._task is None
+    coap.t.join(timeout=0.5)
+    assert not coap.t.is_alive()
     assert 2 == log_info.call_count  # includes start call log as well, as a GIVEN condition
     stop_call = [call('Stopping South CoAP plugin...')]
     log_info.assert_has_calls(stop_call, any_order=True)
     assert 0 == log_exception.call_count
 
-    coap.loop.stop()
-    coap.t._tstate_lock = None
-    coap.t._stop()
-
 
 @pytest.allure.feature("unit")
 @pytest.allure.story("services", "south", "ingest")
@@ -182,44 +234,11 @@ class TestCoapSouthIngest(object):
     """Unit tests fledge.plugins.south.coap.coap.CoAPIngest
     """
 
+    @pytest.mark.parametrize("reading_key", _READING_KEYS)
     @pytest.mark.asyncio
-    async def test_render_post_ok(self):
-        data = """{
-            "timestamp": "2017-01-02T01:02:03.23232Z-05:00",
-            "asset": "sensor1",
-            "key": "80a43623-ebe5-40d6-8d80-3f892da9b3b4",
-            "readings": {
-                "velocity": "500",
-                "temperature": {
-                    "value": "32",
-                    "unit": "kelvin"
-                }
-            }
-        }"""
-
-        with patch.object(async_ingest, 'ingest_callback') as ingest_add_readings:
-            request = message.Message(payload=cbor2.dumps(json.loads(data)), code=numbers.codes.Code.POST)
-            r = await CoAPIngest.render_post(request)
-            assert numbers.codes.Code.VALID == r.code
-            assert '' == r.payload.decode()
-            assert 1 == ingest_add_readings.call_count
-
-    @pytest.mark.asyncio
-    async def test_render_post_sensor_values_ok(self):
-        data = """{
-            "timestamp": "2017-01-02T01:02:03.23232Z-05:00",
-            "asset": "sensor1",
-            "key": "80a43623-ebe5-40d6-8d80-3f892da9b3b4",
-            "sensor_values": {
-                "velocity": "500",
-                "temperature": {
-                    "value": "32",
-                    "unit": "kelvin"
-                }
-            }
-        }"""
+    async def test_render_post_ok(self, reading_key):
         with patch.object(async_ingest, 'ingest_callback') as ingest_add_readings:
-            request = message.Message(payload=cbor2.dumps(json.loads(data)), code=numbers.codes.Code.POST)
+            request = message.Message(payload=_PAYLOAD_TEMPLATES[reading_key], code=numbers.codes.Code.POST)
             r = await CoAPIngest.render_post(request)
             assert numbers.codes.Code.VALID == r.code
             assert '' == r.payload.decode()
@@ -227,16 +246,10 @@ class TestCoapSouthIngest(object):
 
     @pytest.mark.asyncio
     async def test_render_post_reading_not_dict(self):
-        data = """{
-            "timestamp": "2017-01-02T01:02:03.23232Z-05:00",
-            "asset": "sensor2",
-            "key": "80a43623-ebe5-40d6-8d80-3f892da9b3b4",
-            "readings": "500"
-        }"""
         with patch.object(coap._LOGGER, "exception") as log_exception:
             with patch.object(async_ingest, 'ingest_callback') as ingest_add_readings:
                 with pytest.raises(aiocoap.error.BadRequest) as excinfo:
-                    request = message.Message(payload=cbor2.dumps(json.loads(data)), code=numbers.codes.Code.POST)
+                    request = message.Message(payload=_PAYLOAD_READING_NOT_DICT, code=numbers.codes.Code.POST)
                     r = await CoAPIngest.render_post(request)
                     assert str(excinfo).endswith('readings must be a dictionary')
                 assert 1 == log_exception.call_count